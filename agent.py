@@ -7,106 +7,382 @@ from google.adk.models.llm_response import LlmResponse
 from google.adk.tools.base_tool import BaseTool
 from google.adk.tools.tool_context import ToolContext
 from google.genai import types # For types.Content
-from typing import Optional, Any
+from typing import Optional, Any, Callable, Collection
+import atexit
+import collections
+import copy
+import hashlib
+import logging
+import logging.handlers
+import os
+import queue
+import re
+import time
+
+
+# Names compared on every model call. CPython interns identifier-like string
+# constants at compile time, so these are already interned.
+_TRANSFER_TO_AGENT = "transfer_to_agent"
+_AGENT_NAME_KEY = "agent_name"
+_TEXT_CONTENT_TYPE = "text"
+
+
+# --- Callback Logging ---
+# Callbacks run on the hot path of every agent/model/tool hop, so output goes
+# through a QueueHandler and is formatted and written to stderr by a
+# background listener thread. Each callback logs one INFO line plus DEBUG
+# details; set CALLBACK_LOG_LEVEL=INFO to skip the details and their
+# formatting cost, or WARNING to silence callback output entirely.
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that leaves message formatting to the listener thread.
+
+    The stock handler formats each record before enqueueing it, which keeps
+    that work on the callback's critical path. Callers must therefore pass
+    snapshots (not live objects) of anything that may change afterwards.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+def _setup_callback_logger() -> logging.Logger:
+    logger = logging.getLogger("adk.callbacks")
+    if logger.handlers:
+        return logger # Already configured (module re-imported)
+    try:
+        logger.setLevel(os.environ.get("CALLBACK_LOG_LEVEL", "DEBUG").upper())
+    except ValueError:
+        logger.setLevel(logging.DEBUG) # Unknown level name, fall back to the default
+    logger.propagate = False
+
+    log_queue = queue.Queue(-1)
+    stream_handler = logging.StreamHandler() # Defaults to stderr
+    stream_handler.setFormatter(logging.Formatter("%(message)s"))
+    listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    listener.start()
+    atexit.register(listener.stop) # Flush pending records on exit
+
+    logger.addHandler(_DeferredQueueHandler(log_queue))
+    return logger
+
+_log = _setup_callback_logger()
+
+
+# --- Model Response Cache ---
+# Identical text-only requests to the same agent (e.g. "price of TSLA" in a
+# fresh session) get the same answer within a short window, so the final
+# response is cached and replayed from before_model_callback, skipping the
+# model (and search) round trip entirely.
+# The cache is process-wide and shared across all users and sessions, so a
+# quote can be up to _RESPONSE_CACHE_TTL seconds stale; that is intended for
+# this "realtime" agent as the price of skipping repeat searches.
+_RESPONSE_CACHE_MAXSIZE = 1024
+_RESPONSE_CACHE_TTL = 60.0 # Seconds
+_RESPONSE_CACHE: collections.OrderedDict[bytes, tuple[float, LlmResponse]] = collections.OrderedDict()
+# Invocation-scoped state key carrying the request's cache key to after_model_callback
+_RESPONSE_CACHE_KEY_STATE = "temp:response_cache_key"
+
+def _response_cache_key(agent_name: str, llm_request: LlmRequest) -> Optional[bytes]:
+    """Returns a digest of the agent and request text, or None if not cacheable."""
+    hasher = hashlib.blake2b(agent_name.encode(), digest_size=16)
+    for content in llm_request.contents:
+        hasher.update(b"\x00")
+        hasher.update((content.role or "").encode())
+        for part in content.parts or ():
+            if not part.text:
+                return None # Only pure-text conversations are cached
+            hasher.update(b"\x00")
+            hasher.update(part.text.encode())
+    return hasher.digest()
+
+def _response_cache_get(key: bytes) -> Optional[LlmResponse]:
+    entry = _RESPONSE_CACHE.get(key)
+    if entry is None:
+        return None
+    expires_at, cached_response = entry
+    if expires_at < time.monotonic():
+        del _RESPONSE_CACHE[key]
+        return None
+    _RESPONSE_CACHE.move_to_end(key)
+    return cached_response.model_copy(deep=True)
+
+def _response_cache_put(key: bytes, llm_response: LlmResponse) -> None:
+    # Keep the google_search grounding (citations and Search Suggestions)
+    # with the answer; Gemini grounding requires them to be displayed
+    cached_response = LlmResponse(
+        content=llm_response.content,
+        grounding_metadata=llm_response.grounding_metadata,
+    )
+    _RESPONSE_CACHE[key] = (time.monotonic() + _RESPONSE_CACHE_TTL, cached_response.model_copy(deep=True))
+    _RESPONSE_CACHE.move_to_end(key)
+    if len(_RESPONSE_CACHE) > _RESPONSE_CACHE_MAXSIZE:
+        _RESPONSE_CACHE.popitem(last=False)
+
+
+# --- Plan Cache ---
+# A delegating agent's plan for a stock query is always "transfer to the
+# search agent", whatever the ticker. Once a model call has produced that
+# plan, later messages with the same intent keywords get the transfer call
+# synthesized directly instead of paying for another planning round trip.
+# Only the agent's own sub-agents are recorded, and entries expire so a plan
+# that stops working is retried against the model.
+# A message must name stocks/tickers *and* ask for a price/quote or include
+# a ticker-like symbol; loose words alone ("share a recipe", "price of a
+# pizza", "a famous quote") must never skip the model.
+_STOCK_KEYWORDS = re.compile(r"\b(stocks?|tickers?)\b", re.IGNORECASE)
+_PRICE_KEYWORDS = re.compile(r"\b(prices?|quotes?)\b", re.IGNORECASE)
+_TICKER_SYMBOL = re.compile(r"\b[A-Z]{2,5}\b")
+_PLAN_CACHE_TTL = 300.0 # Seconds
+_PLAN_CACHE: dict[tuple[str, str], tuple[float, str]] = {} # (agent, keywords) -> (expiry, target agent)
+# Invocation-scoped state key carrying the request's plan key to after_model_callback
+_PLAN_CACHE_KEY_STATE = "temp:plan_cache_key"
+
+def _plan_cache_key(llm_request: LlmRequest) -> Optional[str]:
+    """Returns the sorted stock-intent keywords of a new user message, or None."""
+    if not llm_request.contents:
+        return None
+    last_content = llm_request.contents[-1]
+    if last_content.role != "user" or not last_content.parts:
+        return None # Only plan fresh user turns, not tool/agent results
+    if not all(part.text for part in last_content.parts):
+        return None
+    text = " ".join(part.text for part in last_content.parts)
+
+    stock_words = _STOCK_KEYWORDS.findall(text)
+    if not stock_words:
+        return None
+    price_words = _PRICE_KEYWORDS.findall(text)
+    if not price_words and not _TICKER_SYMBOL.search(text):
+        return None
+    # Tickers are left out of the key: the plan is the same for every ticker
+    return ",".join(sorted({word.lower() for word in stock_words + price_words}))
+
+def _plan_cache_get(agent_name: str, plan_key: str) -> Optional[str]:
+    entry = _PLAN_CACHE.get((agent_name, plan_key))
+    if entry is None:
+        return None
+    expires_at, target_agent = entry
+    if expires_at < time.monotonic():
+        del _PLAN_CACHE[(agent_name, plan_key)]
+        return None
+    return target_agent
+
+def _plan_cache_put(agent_name: str, plan_key: str, target_agent: str) -> None:
+    _PLAN_CACHE[(agent_name, plan_key)] = (time.monotonic() + _PLAN_CACHE_TTL, target_agent)
+
+def _transfer_explanation_part(target_agent: str) -> types.Part:
+    # A fresh Part per call: ADK stores response parts in session events
+    # without copying them, and types.Part is mutable, so it is not memoized
+    return types.Part(text=f"Handing off to `{target_agent}` to complete the request.")
 
 
 # --- Agent Callbacks ---
 def before_agent_callback(callback_context: CallbackContext) -> Optional[types.Content]:
-    print(f"\n[Callback] ==> BEFORE AGENT: {callback_context.agent_name}")
-    print(f"    State: {callback_context.state.to_dict()}")
+    _log.info("\n[Callback] ==> BEFORE AGENT: %s", callback_context.agent_name)
+    if _log.isEnabledFor(logging.DEBUG):
+        _log.debug("    State: %s", callback_context.state.to_dict())
     return None # Return None to allow agent to run
 
 def after_agent_callback(callback_context: CallbackContext) -> Optional[types.Content]:
-    print(f"\n[Callback] <== AFTER AGENT: {callback_context.agent_name}")
-    print(f"    State: {callback_context.state.to_dict()}")
+    _log.info("\n[Callback] <== AFTER AGENT: %s", callback_context.agent_name)
+    if _log.isEnabledFor(logging.DEBUG):
+        _log.debug("    State: %s", callback_context.state.to_dict())
     return None # Return None to allow agent to run
 
 # --- Model Callbacks ---
-def before_model_callback(callback_context: CallbackContext, llm_request: LlmRequest) -> Optional[LlmResponse]:
-    print(f"\n[Callback] --> BEFORE MODEL CALL for agent: {callback_context.agent_name}")
-    content_types = []
-    for content in llm_request.contents:
-        for part in content.parts:
-            if part.text:
-                content_types.append("text")
-            if part.inline_data and part.inline_data.mime_type:
-                content_types.append(part.inline_data.mime_type)
-            if part.file_data and part.file_data.mime_type:
-                content_types.append(part.file_data.mime_type)
-    if content_types:
-        print(f"    Content Types: {', '.join(sorted(list(set(content_types))))}")
-    return None # Return None to proceed with the model call
-
-def after_model_callback(callback_context: CallbackContext, llm_response: LlmResponse) -> Optional[LlmResponse]:
-    if llm_response.content and llm_response.content.parts:
-        # Check if there is a transfer_to_agent call in the response
-        transfer_call_part = None
-        for part in llm_response.content.parts:
-            if part.function_call and part.function_call.name == "transfer_to_agent":
-                transfer_call_part = part
-                break
-
-        # If a transfer is happening, decide if we need to add an explanation
-        if transfer_call_part:
-            # Check if the LLM already provided a text explanation
-            has_text_reason = any(
-                part.text.strip() for part in llm_response.content.parts if part.text
-            )
+def make_before_model_callback(agent_can_transfer: bool) -> Callable[[CallbackContext, LlmRequest], Optional[LlmResponse]]:
+    """Builds a before_model_callback specialized for one agent.
 
-            if not has_text_reason:
-                # The LLM didn't provide a reason, so we'll add a generic one.
-                try:
-                    target_agent = transfer_call_part.args["agent_name"]
-                    explanation_text = (
-                        f"Handing off to `{target_agent}` to complete the request."
-                    )
-                    explanation_part = types.Part(text=explanation_text)
-                    new_parts = [explanation_part] + list(llm_response.content.parts)
-                    new_content = types.Content(
-                        parts=new_parts, role=llm_response.content.role
-                    )
-                    # Return the modified response
-                    return LlmResponse(
-                        content=new_content,
-                        usage_metadata=llm_response.usage_metadata,
+    Agents that cannot transfer (leaf agents such as search_format_agent)
+    never record a plan, so their callback skips the plan cache entirely.
+    """
+    def before_model_callback(callback_context: CallbackContext, llm_request: LlmRequest) -> Optional[LlmResponse]:
+        _log.info("\n[Callback] --> BEFORE MODEL CALL for agent: %s", callback_context.agent_name)
+        # Content types are only collected for logging, so skip the scan when off
+        if _log.isEnabledFor(logging.DEBUG):
+            content_types = set()
+            for content in llm_request.contents:
+                for part in content.parts:
+                    if part.text:
+                        content_types.add(_TEXT_CONTENT_TYPE)
+                    inline_data = part.inline_data
+                    if inline_data is not None and inline_data.mime_type:
+                        content_types.add(inline_data.mime_type)
+                    file_data = part.file_data
+                    if file_data is not None and file_data.mime_type:
+                        content_types.add(file_data.mime_type)
+            if content_types:
+                _log.debug("    Content Types: %s", ', '.join(sorted(content_types)))
+
+        cache_key = _response_cache_key(callback_context.agent_name, llm_request)
+        if cache_key is not None:
+            cached_response = _response_cache_get(cache_key)
+            if cached_response is not None:
+                _log.debug("    Response cache hit, skipping model call")
+                return cached_response # Replace the model call
+
+        # Only agents that can transfer have a plan worth caching
+        plan_key = _plan_cache_key(llm_request) if agent_can_transfer else None
+        if plan_key is not None:
+            target_agent = _plan_cache_get(callback_context.agent_name, plan_key)
+            if target_agent is not None:
+                _log.debug("    Plan cache hit, transferring to %s", target_agent)
+                transfer_call = types.FunctionCall(
+                    name=_TRANSFER_TO_AGENT, args={_AGENT_NAME_KEY: target_agent}
+                )
+                return LlmResponse( # Replace the planning model call
+                    content=types.Content(
+                        parts=[_transfer_explanation_part(target_agent), types.Part(function_call=transfer_call)],
+                        role="model",
                     )
-                except (KeyError, TypeError):
-                    # Fall through if args are not as expected
-                    pass
+                )
+
+        # Always overwrite so stale keys from an earlier call are never reused
+        callback_context.state[_RESPONSE_CACHE_KEY_STATE] = cache_key.hex() if cache_key else None
+        if agent_can_transfer:
+            callback_context.state[_PLAN_CACHE_KEY_STATE] = plan_key
+        return None # Return None to proceed with the model call
+
+    return before_model_callback
+
+def make_after_model_callback(
+    agent_can_transfer: bool, sub_agent_names: Collection[str] = ()
+) -> Callable[[CallbackContext, LlmResponse], Optional[LlmResponse]]:
+    """Builds an after_model_callback specialized for one agent.
+
+    Agents that cannot transfer (leaf agents such as search_format_agent)
+    never emit transfer_to_agent, so their callback skips the transfer scan.
+    Only transfers to one of sub_agent_names are recorded in the plan cache.
+    """
+    sub_agent_names = frozenset(sub_agent_names)
+
+    def after_model_callback(callback_context: CallbackContext, llm_response: LlmResponse) -> Optional[LlmResponse]:
+        content = llm_response.content
+        parts = content.parts if content else None
+        has_function_call = False
+        if parts and agent_can_transfer:
+            # Single pass: find any transfer_to_agent call and whether the LLM
+            # already provided a text explanation, stopping once both are known
+            transfer_call_part = None
+            has_text_reason = False
+            for part in parts:
+                function_call = part.function_call
+                if function_call is not None:
+                    has_function_call = True
+                if (
+                    transfer_call_part is None
+                    and function_call is not None
+                    and function_call.name == _TRANSFER_TO_AGENT
+                ):
+                    transfer_call_part = part
+                text = part.text
+                if text and text.strip():
+                    has_text_reason = True
+                if transfer_call_part is not None and has_text_reason:
+                    break
+
+            if transfer_call_part:
+                transfer_args = transfer_call_part.function_call.args
+                target_agent = (
+                    transfer_args.get(_AGENT_NAME_KEY) if isinstance(transfer_args, dict) else None
+                )
+
+                # Fall through if args are not as expected (the model may
+                # send any JSON value, not just a non-empty name)
+                if isinstance(target_agent, str) and target_agent:
+                    # Remember the plan for later messages with the same intent,
+                    # but never a made-up target that the transfer would reject
+                    plan_key = callback_context.state.get(_PLAN_CACHE_KEY_STATE)
+                    if plan_key and target_agent in sub_agent_names:
+                        _plan_cache_put(callback_context.agent_name, plan_key, target_agent)
+
+                    # If the transfer has no reason, add a generic one
+                    if not has_text_reason:
+                        new_parts = [_transfer_explanation_part(target_agent)]
+                        new_parts.extend(parts)
+                        new_content = types.Content(
+                            parts=new_parts, role=content.role
+                        )
+                        # Return the modified response
+                        return LlmResponse(
+                            content=new_content,
+                            usage_metadata=llm_response.usage_metadata,
+                        )
+        elif parts:
+            # Leaf agents never transfer, so only check for function calls
+            for part in parts:
+                if part.function_call is not None:
+                    has_function_call = True
+                    break
 
-    # Default behavior for all other cases (no transfer or transfer with reason)
-    print(f"\n[Callback] <-- AFTER MODEL CALL for agent: {callback_context.agent_name}")
-    if llm_response.usage_metadata:
+        # Cache complete, text-only answers for replay by before_model_callback
+        cache_key = callback_context.state.get(_RESPONSE_CACHE_KEY_STATE)
+        if (
+            cache_key
+            and parts
+            and not has_function_call
+            and not llm_response.partial
+            and not llm_response.error_code
+        ):
+            _response_cache_put(bytes.fromhex(cache_key), llm_response)
+
+        # Default behavior for all other cases (no transfer or transfer with reason)
+        _log.info("\n[Callback] <-- AFTER MODEL CALL for agent: %s", callback_context.agent_name)
         usage = llm_response.usage_metadata
-        print("    Token Usage:")
-        if usage.prompt_token_count:
-            print(f"        Prompt: {usage.prompt_token_count}")
-        if usage.candidates_token_count:
-            print(f"        Candidates: {usage.candidates_token_count}")
-        if usage.total_token_count:
-            print(f"        Total: {usage.total_token_count}")
-    return None
+        if usage and _log.isEnabledFor(logging.DEBUG):
+            # One record, listing only the counts the model reported
+            token_counts = " ".join(
+                f"{label}={count}"
+                for label, count in (
+                    ("Prompt", usage.prompt_token_count),
+                    ("Candidates", usage.candidates_token_count),
+                    ("Total", usage.total_token_count),
+                )
+                if count
+            )
+            if token_counts:
+                _log.debug("    Token Usage: %s", token_counts)
+        return None
+
+    return after_model_callback
 
 # --- Tool Callbacks ---
 def before_tool_callback(tool: BaseTool, args: dict[str, Any], tool_context: ToolContext) -> Optional[dict]:
-    print(f"\n[Callback] --> BEFORE TOOL CALL: {tool.name}")
-    print(f"    Agent: {tool_context.agent_name}")
-    print(f"    Args: {args}")
+    _log.info("\n[Callback] --> BEFORE TOOL CALL: %s", tool.name)
+    _log.debug("    Agent: %s", tool_context.agent_name)
+    if _log.isEnabledFor(logging.DEBUG):
+        _log.debug("    Args: %s", dict(args)) # Snapshot, formatted later
     return None # Return None to proceed with the tool call
 
 def after_tool_callback(tool: BaseTool, args: dict[str, Any], tool_context: ToolContext, tool_response: dict) -> Optional[dict]:
-    print(f"\n[Callback] <-- AFTER TOOL CALL: {tool.name}")
-    print(f"    Agent: {tool_context.agent_name}")
-    print(f"    Response: {tool_response}")
+    _log.info("\n[Callback] <-- AFTER TOOL CALL: %s", tool.name)
+    _log.debug("    Agent: %s", tool_context.agent_name)
+    if _log.isEnabledFor(logging.DEBUG):
+        _log.debug("    Response: %s", copy.copy(tool_response)) # Snapshot, formatted later
     return None # Return None to use the original tool response
 
-search_format_agent = LlmAgent(
-    name="search_format_agent",
-    model="gemini-2.0-flash",
-    description="searches the internet using google and formats outputs from other agents",
-    instruction="""
+# Callback set shared by every agent, built once at import time;
+# the model callbacks are specialized per agent below
+_CALLBACKS = {
+    # All before callbacks
+    "before_agent_callback": before_agent_callback,
+    "before_tool_callback": before_tool_callback,
+
+    # All after callbacks
+    "after_agent_callback": after_agent_callback,
+    "after_tool_callback": after_tool_callback,
+}
+
+# --- Agent Instructions ---
+# Instructions are sent as the system prompt on every model call. They are
+# kept as static constants, with no {state} placeholders, so the prompt prefix
+# is byte-identical across turns and eligible for Gemini's implicit prompt
+# caching. Any per-turn templating should be appended at the end.
+_SEARCH_FORMAT_INSTRUCTION = """
     You MUST use the google_search tool to find the most recent stock price for
-    the given stock ticker.
+    each of the given stock tickers.
+
+    If more than one ticker is requested, search for all of them in the same
+    turn rather than one after another.
 
     Once you have the information, provide the stock price along with the most
     recent date in JSON format like this:
@@ -115,17 +391,33 @@ search_format_agent = LlmAgent(
         "price": "173.95",
         "date": "2024-02-23"
     }
-    """,
 
-    # All before callbacks
-    before_agent_callback=before_agent_callback,
-    before_model_callback=before_model_callback,
-    before_tool_callback=before_tool_callback,
+    For more than one ticker, return a JSON list with one such object per
+    ticker, in the order they were requested.
+    """
 
-    # All after callbacks
-    after_agent_callback=after_agent_callback,
-    after_model_callback=after_model_callback,
-    after_tool_callback=after_tool_callback,
+_ROOT_INSTRUCTION = """Your job is to delegate tasks to the correct sub-agent based on its description.
+When you decide to transfer to a sub-agent, you MUST first output a brief, user-facing sentence explaining your reasoning for the transfer.
+After the explanation, you MUST call the `transfer_to_agent` function.
+
+For example, if the user asks for a stock price, you might say:
+"I need to find the latest stock information, so I'll hand this over to the search agent."
+Then you would call the `transfer_to_agent` function.
+
+If the user asks about several stocks at once, transfer only once and pass
+along every ticker; the search agent looks them all up together.
+"""
+
+search_format_agent = LlmAgent(
+    name="search_format_agent",
+    model="gemini-2.0-flash",
+    description="searches the internet using google and formats outputs from other agents",
+    instruction=_SEARCH_FORMAT_INSTRUCTION,
+
+    # All before and after callbacks
+    **_CALLBACKS,
+    before_model_callback=make_before_model_callback(agent_can_transfer=False),
+    after_model_callback=make_after_model_callback(agent_can_transfer=False),
 
     # Tool
     tools=[google_search],
@@ -140,24 +432,14 @@ root_agent = LlmAgent(
     name="root_agent",
     model="gemini-2.0-flash",
     description="You are an agent that provides realtime stock quotes using the latest google data",
-    instruction="""Your job is to delegate tasks to the correct sub-agent based on its description.
-When you decide to transfer to a sub-agent, you MUST first output a brief, user-facing sentence explaining your reasoning for the transfer.
-After the explanation, you MUST call the `transfer_to_agent` function.
+    instruction=_ROOT_INSTRUCTION,
 
-For example, if the user asks for a stock price, you might say:
-"I need to find the latest stock information, so I'll hand this over to the search agent."
-Then you would call the `transfer_to_agent` function.
-""",
-
-    # All before callbacks
-    before_agent_callback=before_agent_callback,
-    before_model_callback=before_model_callback,
-    before_tool_callback=before_tool_callback,
-
-    # All after callbacks
-    after_agent_callback=after_agent_callback,
-    after_model_callback=after_model_callback,
-    after_tool_callback=after_tool_callback,
+    # All before and after callbacks
+    **_CALLBACKS,
+    before_model_callback=make_before_model_callback(agent_can_transfer=True),
+    after_model_callback=make_after_model_callback(
+        agent_can_transfer=True, sub_agent_names=[search_format_agent.name]
+    ),
 
     # Sub-Agent
     sub_agents=[search_format_agent],
@@ -0,0 +1,239 @@
+# Unit tests for the callback caches in agent.py (no model calls are made)
+from types import SimpleNamespace
+
+import pytest
+from google.adk.models.llm_request import LlmRequest
+from google.adk.models.llm_response import LlmResponse
+from google.genai import types
+
+import agent
+
+
+@pytest.fixture(autouse=True)
+def clear_caches():
+    agent._RESPONSE_CACHE.clear()
+    agent._PLAN_CACHE.clear()
+    yield
+    agent._RESPONSE_CACHE.clear()
+    agent._PLAN_CACHE.clear()
+
+
+def make_request(*texts: str, role: str = "user") -> LlmRequest:
+    return LlmRequest(
+        contents=[types.Content(role=role, parts=[types.Part(text=text)]) for text in texts]
+    )
+
+def make_response(text: str = "answer", **kwargs) -> LlmResponse:
+    return LlmResponse(
+        content=types.Content(role="model", parts=[types.Part(text=text)]), **kwargs
+    )
+
+def make_context(agent_name: str = "search_format_agent", **state) -> SimpleNamespace:
+    return SimpleNamespace(agent_name=agent_name, state=dict(state))
+
+
+# --- _response_cache_key ---
+def test_response_cache_key_is_stable_for_same_agent_and_text():
+    key = agent._response_cache_key("search_format_agent", make_request("price of TSLA"))
+    assert key == agent._response_cache_key("search_format_agent", make_request("price of TSLA"))
+    assert len(key) == 16
+
+def test_response_cache_key_differs_by_agent_text_and_role():
+    key = agent._response_cache_key("search_format_agent", make_request("price of TSLA"))
+    assert key != agent._response_cache_key("root_agent", make_request("price of TSLA"))
+    assert key != agent._response_cache_key("search_format_agent", make_request("price of AAPL"))
+    assert key != agent._response_cache_key("search_format_agent", make_request("price of TSLA", role="model"))
+
+def test_response_cache_key_separates_part_boundaries():
+    joined = agent._response_cache_key("a", make_request("ab", "c"))
+    assert joined != agent._response_cache_key("a", make_request("a", "bc"))
+
+def test_response_cache_key_is_none_for_non_text_parts():
+    llm_request = make_request("price of TSLA")
+    llm_request.contents[0].parts.append(
+        types.Part(function_call=types.FunctionCall(name="google_search", args={}))
+    )
+    assert agent._response_cache_key("search_format_agent", llm_request) is None
+
+
+# --- _response_cache_get / _response_cache_put ---
+def test_response_cache_round_trip_keeps_grounding_metadata():
+    grounding = types.GroundingMetadata(web_search_queries=["TSLA stock price"])
+    agent._response_cache_put(b"key", make_response(grounding_metadata=grounding))
+    cached = agent._response_cache_get(b"key")
+    assert cached.content.parts[0].text == "answer"
+    assert cached.grounding_metadata.web_search_queries == ["TSLA stock price"]
+
+def test_response_cache_get_misses_unknown_key():
+    assert agent._response_cache_get(b"missing") is None
+
+def test_response_cache_deep_copies_on_put_and_get():
+    llm_response = make_response()
+    agent._response_cache_put(b"key", llm_response)
+    llm_response.content.parts[0].text = "changed after put"
+    cached = agent._response_cache_get(b"key")
+    cached.content.parts[0].text = "changed after get"
+    assert agent._response_cache_get(b"key").content.parts[0].text == "answer"
+
+def test_response_cache_drops_expired_entries(monkeypatch):
+    monkeypatch.setattr(agent, "_RESPONSE_CACHE_TTL", -1.0)
+    agent._response_cache_put(b"key", make_response())
+    assert agent._response_cache_get(b"key") is None
+    assert b"key" not in agent._RESPONSE_CACHE
+
+def test_response_cache_evicts_least_recently_used(monkeypatch):
+    monkeypatch.setattr(agent, "_RESPONSE_CACHE_MAXSIZE", 2)
+    agent._response_cache_put(b"a", make_response())
+    agent._response_cache_put(b"b", make_response())
+    agent._response_cache_get(b"a") # Refresh "a" so "b" is the oldest
+    agent._response_cache_put(b"c", make_response())
+    assert list(agent._RESPONSE_CACHE) == [b"a", b"c"]
+
+
+# --- Response caching through the model callbacks ---
+@pytest.mark.parametrize("agent_can_transfer", [False, True])
+def test_before_model_callback_stores_key_and_replays_hit(agent_can_transfer):
+    before_model_callback = agent.make_before_model_callback(agent_can_transfer=agent_can_transfer)
+    after_model_callback = agent.make_after_model_callback(agent_can_transfer=agent_can_transfer)
+    callback_context = make_context()
+
+    assert before_model_callback(callback_context, make_request("hello")) is None
+    assert callback_context.state[agent._RESPONSE_CACHE_KEY_STATE]
+    assert after_model_callback(callback_context, make_response()) is None
+
+    replayed = before_model_callback(make_context(), make_request("hello"))
+    assert replayed.content.parts[0].text == "answer"
+
+def test_before_model_callback_clears_stale_key_for_uncacheable_request():
+    before_model_callback = agent.make_before_model_callback(agent_can_transfer=False)
+    callback_context = make_context(**{agent._RESPONSE_CACHE_KEY_STATE: "00"})
+    llm_request = make_request("hello")
+    llm_request.contents[0].parts.append(types.Part(inline_data=types.Blob(mime_type="image/png", data=b"")))
+    before_model_callback(callback_context, llm_request)
+    assert callback_context.state[agent._RESPONSE_CACHE_KEY_STATE] is None
+
+@pytest.mark.parametrize(
+    "llm_response",
+    [
+        LlmResponse(
+            content=types.Content(
+                role="model",
+                parts=[types.Part(function_call=types.FunctionCall(name="google_search", args={}))],
+            )
+        ),
+        make_response(partial=True),
+        make_response(error_code="SAFETY"),
+        LlmResponse(content=types.Content(role="model", parts=[])),
+    ],
+    ids=["function_call", "partial", "error", "empty"],
+)
+def test_after_model_callback_does_not_cache(llm_response):
+    after_model_callback = agent.make_after_model_callback(agent_can_transfer=False)
+    callback_context = make_context(**{agent._RESPONSE_CACHE_KEY_STATE: b"key".hex()})
+    after_model_callback(callback_context, llm_response)
+    assert not agent._RESPONSE_CACHE
+
+def test_after_model_callback_caches_under_state_key():
+    after_model_callback = agent.make_after_model_callback(agent_can_transfer=False)
+    callback_context = make_context(**{agent._RESPONSE_CACHE_KEY_STATE: b"key".hex()})
+    after_model_callback(callback_context, make_response())
+    assert list(agent._RESPONSE_CACHE) == [b"key"]
+
+
+# --- Transfer handling in after_model_callback ---
+def make_transfer_response(args) -> LlmResponse:
+    transfer_call = types.FunctionCall(name=agent._TRANSFER_TO_AGENT, args=args)
+    return LlmResponse(
+        content=types.Content(role="model", parts=[types.Part(function_call=transfer_call)])
+    )
+
+def test_after_model_callback_adds_explanation_to_silent_transfer():
+    after_model_callback = agent.make_after_model_callback(agent_can_transfer=True)
+    response = after_model_callback(
+        make_context("root_agent"), make_transfer_response({"agent_name": "search_format_agent"})
+    )
+    assert response.content.parts[0].text == "Handing off to `search_format_agent` to complete the request."
+    assert response.content.parts[1].function_call.name == agent._TRANSFER_TO_AGENT
+
+@pytest.mark.parametrize(
+    "args",
+    [None, {}, {"agent_name": None}, {"agent_name": ""}, {"agent_name": ["search_format_agent"]}, {"agent_name": {"name": "x"}}],
+    ids=["no_args", "missing", "null", "empty", "list", "dict"],
+)
+def test_after_model_callback_ignores_malformed_transfer_args(args):
+    after_model_callback = agent.make_after_model_callback(agent_can_transfer=True)
+    assert after_model_callback(make_context("root_agent"), make_transfer_response(args)) is None
+
+
+# --- Plan cache ---
+def make_root_callbacks():
+    return (
+        agent.make_before_model_callback(agent_can_transfer=True),
+        agent.make_after_model_callback(agent_can_transfer=True, sub_agent_names=["search_format_agent"]),
+    )
+
+def test_plan_cache_replays_transfer_to_known_sub_agent():
+    before_model_callback, after_model_callback = make_root_callbacks()
+    callback_context = make_context("root_agent")
+    assert before_model_callback(callback_context, make_request("What is the TSLA stock price?")) is None
+    after_model_callback(callback_context, make_transfer_response({"agent_name": "search_format_agent"}))
+
+    replayed = before_model_callback(make_context("root_agent"), make_request("AAPL stock price please"))
+    assert replayed.content.parts[0].text == "Handing off to `search_format_agent` to complete the request."
+    assert replayed.content.parts[1].function_call.args == {"agent_name": "search_format_agent"}
+
+def test_plan_cache_ignores_unknown_transfer_target():
+    before_model_callback, after_model_callback = make_root_callbacks()
+    callback_context = make_context("root_agent")
+    before_model_callback(callback_context, make_request("What is the TSLA stock price?"))
+    after_model_callback(callback_context, make_transfer_response({"agent_name": "stock_agent"}))
+    assert not agent._PLAN_CACHE
+
+def test_plan_cache_entries_expire(monkeypatch):
+    monkeypatch.setattr(agent, "_PLAN_CACHE_TTL", -1.0)
+    agent._plan_cache_put("root_agent", "price,stock", "search_format_agent")
+    assert agent._plan_cache_get("root_agent", "price,stock") is None
+    assert not agent._PLAN_CACHE
+
+def test_leaf_agent_skips_plan_cache():
+    before_model_callback = agent.make_before_model_callback(agent_can_transfer=False)
+    callback_context = make_context()
+    agent._plan_cache_put("search_format_agent", "price,stock", "search_format_agent")
+    assert before_model_callback(callback_context, make_request("What is the TSLA stock price?")) is None
+    assert agent._PLAN_CACHE_KEY_STATE not in callback_context.state
+
+@pytest.mark.parametrize(
+    "text, expected",
+    [
+        ("What is the TSLA stock price?", "price,stock"),
+        ("Stock quote for AAPL", "quote,stock"),
+        ("How is GOOG stock doing?", "stock"),
+        ("price of these stocks", "price,stocks"),
+        ("Look up the ticker price", "price,ticker"),
+    ],
+)
+def test_plan_cache_key_matches_stock_intent(text, expected):
+    assert agent._plan_cache_key(make_request(text)) == expected
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "Can you share a recipe?",
+        "price of a pizza in Rome",
+        "a famous quote about courage",
+        "I need chicken stock for this soup",
+        "What is TSLA?",
+        "hello",
+    ],
+)
+def test_plan_cache_key_rejects_non_stock_messages(text):
+    assert agent._plan_cache_key(make_request(text)) is None
+
+def test_plan_cache_key_only_considers_fresh_user_turns():
+    assert agent._plan_cache_key(make_request("TSLA stock price", role="model")) is None
+    assert agent._plan_cache_key(LlmRequest(contents=[])) is None
+    llm_request = make_request("TSLA stock price")
+    llm_request.contents[0].parts.append(
+        types.Part(function_response=types.FunctionResponse(name="transfer_to_agent", response={}))
+    )
+    assert agent._plan_cache_key(llm_request) is None